@@ -1,12 +1,16 @@
+import argparse
+
 from datetime import date
 from typing import Literal
 
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
+from cal_bxfx_external import compute_bxfx
 from db import SessionLocal, engine
+from db.codec import encode_patents
 from db.log import get_logger
-from db.models import Base, ExtendedInfo, Patent
+from db.models import STORAGE_MAPPING, Base, ExtendedInfo, ExtendedInfoCompact, Patent
 
 
 logger = get_logger(__name__)
@@ -72,18 +76,41 @@ def get_bxfx(db: Session, focus_patent: str) -> tuple[set[str], set[str], set[st
     return b1f0, b1f1, b0f1
 
 
-if __name__ == "__main__":
-    logger.info("开始计算b1f0, b1f1, b0f1")
-
-    # Create tables if they do not exist
-    Base.metadata.create_all(bind=engine)
-
-    session = SessionLocal()
+def build_extended_info(
+    db: Session, publication_number: str, b1f0: set[str], b1f1: set[str], b0f1: set[str], storage: str
+) -> ExtendedInfo | ExtendedInfoCompact:
+    """
+    按存储格式构造 ExtendedInfo / ExtendedInfoCompact 行
+    """
+    if storage == "text":
+        return ExtendedInfo(
+            publication_number=publication_number,
+            b1f0_patents=",".join(b1f0),
+            b1f1_patents=",".join(b1f1),
+            b0f1_patents=",".join(b0f1),
+        )
+
+    b1f0_count, b1f0_ids = encode_patents(db, b1f0)
+    b1f1_count, b1f1_ids = encode_patents(db, b1f1)
+    b0f1_count, b0f1_ids = encode_patents(db, b0f1)
+    return ExtendedInfoCompact(
+        publication_number=publication_number,
+        b1f0_count=b1f0_count,
+        b1f1_count=b1f1_count,
+        b0f1_count=b0f1_count,
+        b1f0_ids=b1f0_ids,
+        b1f1_ids=b1f1_ids,
+        b0f1_ids=b0f1_ids,
+    )
+
+
+def cal_bxfx_by_query(session: Session, storage: str, batch_size: int):
+    """逐个焦点专利查询数据库计算"""
+    info_model = STORAGE_MAPPING[storage]
     patent_count = session.query(Patent).filter(Patent.listed_company).count()
     logger.info(f"待处理专利数量: {patent_count}")
 
     # 分批遍历所有上市公司专利
-    batch_size = 10000
     with tqdm(total=patent_count) as pbar:
         offset = 0
         while True:
@@ -93,9 +120,7 @@ if __name__ == "__main__":
             patents = [
                 p
                 for p in patents
-                if not session.query(ExtendedInfo)
-                .filter(ExtendedInfo.publication_number == p.publication_number)
-                .first()
+                if not session.query(info_model).filter(info_model.publication_number == p.publication_number).first()
             ]
             if not patents:
                 break
@@ -108,11 +133,13 @@ if __name__ == "__main__":
                 except ValueError as e:
                     logger.error(f"跳过专利 {publication_number}: {e}")
                     continue
-                info = ExtendedInfo(
-                    publication_number=publication_number,
-                    b1f0_patents=",".join(b1f0_patents),
-                    b1f1_patents=",".join(b1f1_patents),
-                    b0f1_patents=",".join(b0f1_patents),
+                info = build_extended_info(
+                    session,
+                    publication_number,  # type: ignore[arg-type]
+                    b1f0_patents,
+                    b1f1_patents,
+                    b0f1_patents,
+                    storage,
                 )
                 session.add(info)
 
@@ -120,5 +147,68 @@ if __name__ == "__main__":
             offset += batch_size
             logger.info(f"已处理 {offset} / {patent_count} 专利")
 
+
+def cal_bxfx_by_external_sort(session: Session, storage: str, batch_size: int, tmp_dir: str, memory_budget: int):
+    """用外部排序归并一次性计算所有焦点专利，内存占用受 memory_budget 限制"""
+    info_model = STORAGE_MAPPING[storage]
+
+    def save(batch: list[tuple[str, set[str], set[str], set[str]]]):
+        # 过滤掉本身就在extendedinfo里的
+        existing = {
+            row[0]
+            for row in session.query(info_model.publication_number)
+            .filter(info_model.publication_number.in_([item[0] for item in batch]))
+            .all()
+        }
+        for publication_number, b1f0_patents, b1f1_patents, b0f1_patents in batch:
+            if publication_number not in existing:
+                session.add(
+                    build_extended_info(session, publication_number, b1f0_patents, b1f1_patents, b0f1_patents, storage)
+                )
+        session.commit()  # 批量提交
+
+    batch: list[tuple[str, set[str], set[str], set[str]]] = []
+    processed = 0
+    for item in compute_bxfx(session, tmp_dir, memory_budget):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            save(batch)
+            processed += len(batch)
+            batch = []
+            logger.info(f"已处理 {processed} 专利")
+    if batch:
+        save(batch)
+        processed += len(batch)
+    logger.info(f"共处理 {processed} 专利")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="计算上市公司专利的b1f0, b1f1, b0f1")
+    arg_parser.add_argument(
+        "--storage",
+        choices=list(STORAGE_MAPPING.keys()),
+        default="text",
+        help="结果的存储格式：逗号分隔文本或压缩id数组",
+    )
+    arg_parser.add_argument(
+        "--mode",
+        choices=["query", "external"],
+        default="query",
+        help="计算方式：逐个专利查询数据库，或基于磁盘的外部排序归并",
+    )
+    arg_parser.add_argument("--batch-size", type=int, default=10000)
+    arg_parser.add_argument("--tmp-dir", type=str, default="tmp/bxfx", help="外部排序的临时文件目录")
+    arg_parser.add_argument("--memory-budget", type=int, default=1024, help="外部排序的内存预算，单位MB")
+    args = arg_parser.parse_args()
+    logger.info(f"开始计算b1f0, b1f1, b0f1，运行参数：{args}")
+
+    # Create tables if they do not exist
+    Base.metadata.create_all(bind=engine)
+
+    session = SessionLocal()
+    if args.mode == "query":
+        cal_bxfx_by_query(session, args.storage, args.batch_size)
+    else:
+        cal_bxfx_by_external_sort(session, args.storage, args.batch_size, args.tmp_dir, args.memory_budget * 1024**2)
     session.close()
     logger.info("计算完成")
@@ -0,0 +1,286 @@
+"""
+基于外部排序归并的 b1f0, b1f1, b0f1 计算，内存占用由 memory_budget 限定，中间结果写入磁盘
+
+所有中间记录均为定长字节串，专利号补齐到 PUB_WIDTH 字节，整数为大端无符号数，
+因此直接比较字节串即可得到按专利号排序的结果（超长专利号见 PubKeys）。记录格式（括号内为排序键）：
+    P: (专利号) 发布日期                         所有专利
+    A: (后向引用b) 焦点专利F, F的日期             上市公司专利的后向引用边
+    B: (专利p) 前向引用x                         所有专利的前向引用边
+    C: (x) F, 类型, F的日期                       焦点专利F与候选专利x的关系
+    D: (F, x) 类型, F的日期, x的日期              按焦点专利分组后流式分类
+"""
+
+import hashlib
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+
+from collections.abc import Iterable, Iterator
+from datetime import date
+from itertools import groupby
+
+from sqlalchemy.orm import Session
+from tqdm import tqdm
+
+from db.log import get_logger
+from db.models import Patent
+
+
+logger = get_logger(__name__)
+
+PUB_WIDTH = 32  # 专利号定长字节数
+LONG_PUB_PREFIX = b"\xff"  # 超长专利号的键前缀，0xff 不会出现在 UTF-8 编码中
+MAX_FAN_IN = 256  # 一次归并最多同时打开的顺段文件数
+MIN_RUN_BUFFER = 64 * 1024  # 归并时每个顺段的最小读缓冲字节数，预算不足时减少一次归并的顺段数
+WRITE_BUFFER = 1024 * 1024  # 写出顺段时的缓冲字节数上限
+FETCH_ROWS = 1000  # 扫描专利表时每次取回的行数，引用字段较长，取回的行不计入预算
+RECORD_OVERHEAD = 45  # 内存中每条记录除自身字节外的开销：bytes 对象头、列表指针和排序时的临时空间
+
+P_RECORD = struct.Struct(f">{PUB_WIDTH}sI")
+A_RECORD = struct.Struct(f">{PUB_WIDTH}s{PUB_WIDTH}sI")
+B_RECORD = struct.Struct(f">{PUB_WIDTH}s{PUB_WIDTH}s")
+C_RECORD = struct.Struct(f">{PUB_WIDTH}s{PUB_WIDTH}sBI")
+D_RECORD = struct.Struct(f">{PUB_WIDTH}s{PUB_WIDTH}sBII")
+
+# C/D 记录中的关系类型
+KIND_FOCUS = 0  # 焦点专利本身的占位记录，保证没有任何引用的焦点专利也会输出
+KIND_MISSING = 1  # 焦点专利的某个后向引用不存在于专利表
+KIND_BACKWARD_FORWARD = 2  # x 是焦点专利某个后向引用的前向引用
+KIND_FORWARD = 3  # x 是焦点专利的前向引用
+
+
+class ExternalSorter:
+    """
+    定长记录的外部排序：内存中累积到上限后排序写出一个顺段，最后多路归并所有顺段
+
+    构造时的 memory_budget 限定排序缓冲（含写出缓冲），sorted 的 memory_budget 限定归并时所有顺段的读缓冲；
+    调用 sorted 时排序缓冲会先写出并释放
+    """
+
+    def __init__(self, record_size: int, tmp_dir: str, memory_budget: int):
+        self.record_size = record_size
+        self.tmp_dir = tmp_dir
+        self.write_buffer = self._buffer_size(min(WRITE_BUFFER, memory_budget // 8))
+        self.max_records = max(1, (memory_budget - self.write_buffer) // (record_size + RECORD_OVERHEAD))
+        self.buffer: list[bytes] = []
+        self.runs: list[str] = []
+
+    def _buffer_size(self, size: int) -> int:
+        """缓冲大小向下取整为记录大小的整数倍，至少一条记录"""
+        return max(self.record_size, size // self.record_size * self.record_size)
+
+    def add(self, record: bytes) -> None:
+        self.buffer.append(record)
+        if len(self.buffer) >= self.max_records:
+            self._flush()
+
+    def _write_run(self, records: Iterable[bytes], buffer_size: int) -> str:
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self.tmp_dir)
+        with os.fdopen(fd, "wb", buffering=buffer_size) as f:
+            for record in records:
+                f.write(record)
+        return path
+
+    def _read_run(self, path: str, buffer_size: int) -> Iterator[bytes]:
+        # 不使用文件对象自带的缓冲，反复读入同一块 buffer_size 字节的缓冲区
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        with open(path, "rb", buffering=0) as f:
+            while size := f.readinto(buffer):  # type: ignore[attr-defined]
+                for offset in range(0, size, self.record_size):
+                    yield bytes(view[offset : offset + self.record_size])
+
+    def _flush(self) -> None:
+        if self.buffer:
+            self.buffer.sort()
+            self.runs.append(self._write_run(self.buffer, self.write_buffer))
+            self.buffer = []
+
+    def sorted(self, memory_budget: int) -> Iterator[bytes]:
+        """返回全部记录的有序迭代器，可多次调用，之后不应再 add"""
+        self._flush()
+        # 每个顺段至少 MIN_RUN_BUFFER 的读缓冲，顺段过多时先分批归并（分批归并还需一份写出缓冲）
+        fan_in = max(2, min(MAX_FAN_IN, memory_budget // MIN_RUN_BUFFER - 1))
+        while len(self.runs) > fan_in:
+            batch, self.runs = self.runs[:fan_in], self.runs[fan_in:]
+            buffer_size = self._buffer_size(memory_budget // (len(batch) + 1))
+            merged = heapq.merge(*[self._read_run(path, buffer_size) for path in batch])
+            self.runs.append(self._write_run(merged, buffer_size))
+            for path in batch:
+                os.remove(path)
+        buffer_size = self._buffer_size(memory_budget // max(1, len(self.runs)))
+        return heapq.merge(*[self._read_run(path, buffer_size) for path in self.runs])
+
+    def cleanup(self) -> None:
+        """删除顺段文件，释放磁盘空间"""
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+        self.buffer = []
+
+
+class PubKeys:
+    """
+    专利号与定长键的相互转换。超过 PUB_WIDTH 字节的专利号（多为脏数据）以 LONG_PUB_PREFIX 加哈希作为键，
+    原文保存在内存中以便还原；这类键不会与普通专利号的键冲突，排在所有普通专利号之后
+    """
+
+    def __init__(self):
+        self.long_pubs: dict[bytes, str] = {}
+
+    def pack(self, pub: str) -> bytes:
+        raw = pub.encode("utf-8")
+        if len(raw) <= PUB_WIDTH:
+            return raw.ljust(PUB_WIDTH, b"\0")
+        key = LONG_PUB_PREFIX + hashlib.sha256(raw).digest()[: PUB_WIDTH - len(LONG_PUB_PREFIX)]
+        if key not in self.long_pubs:
+            logger.warning(f"专利号 {pub} 超过 {PUB_WIDTH} 字节，改用哈希作为排序键")
+            self.long_pubs[key] = pub
+        return key
+
+    def unpack(self, key: bytes) -> str:
+        if key.startswith(LONG_PUB_PREFIX):
+            return self.long_pubs[key]
+        return key.rstrip(b"\0").decode("utf-8")
+
+
+def pack_date(d: date | None) -> int:
+    return d.toordinal() if d else 0
+
+
+def split_citations(citations_str: str | None) -> set[str]:
+    # 去空白、去空项
+    if not citations_str:
+        return set()
+    return {x.strip() for x in citations_str.split(",") if x.strip()}
+
+
+def join_by_key(key_size: int, *streams: Iterable[bytes]) -> Iterator[tuple[bytes, list[list[bytes]]]]:
+    """
+    按前 key_size 字节对多个已排序的记录流做归并连接，返回 (键, 每个流中该键对应的记录列表)
+    """
+
+    def tag(i: int, stream: Iterable[bytes]) -> Iterator[tuple[bytes, int, bytes]]:
+        for record in stream:
+            yield record[:key_size], i, record
+
+    tagged = [tag(i, stream) for i, stream in enumerate(streams)]
+    for key, items in groupby(heapq.merge(*tagged), key=lambda item: item[0]):
+        groups: list[list[bytes]] = [[] for _ in streams]
+        for _, i, record in items:
+            groups[i].append(record)
+        yield key, groups
+
+
+def compute_bxfx(db: Session, tmp_dir: str, memory_budget: int) -> Iterator[tuple[str, set[str], set[str], set[str]]]:
+    """
+    对所有上市公司专利计算 b1f0, b1f1, b0f1，结果与 cal_bxfx.get_bxfx 一致，按专利号顺序返回
+    (焦点专利号, b1f0, b1f1, b0f1)；后向引用中存在专利表中没有的专利时，跳过该焦点专利。
+    超过 PUB_WIDTH 字节的专利号同样参与计算，但排在最后输出
+
+    各阶段同时存在的排序缓冲与归并读缓冲之和不超过 memory_budget：
+        第一遍：P/A/B/C 的排序缓冲各 1/4
+        第二遍：P/A/B 的排序缓冲已写出释放，三路归并的读缓冲各 1/4；C 的排序缓冲 1/4
+        第三遍：C 的排序缓冲已写出释放，C/P 两路归并的读缓冲各 1/4；D 的排序缓冲 1/2
+        第四遍：D 的排序缓冲已写出释放，D 的归并读缓冲占全部预算
+    同一键的记录组、单个焦点专利的结果集合和超长专利号的原文不计入预算
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="bxfx_", dir=tmp_dir)
+    quarter = memory_budget // 4
+    pub_keys = PubKeys()
+    try:
+        p_sorter = ExternalSorter(P_RECORD.size, work_dir, quarter)
+        a_sorter = ExternalSorter(A_RECORD.size, work_dir, quarter)
+        b_sorter = ExternalSorter(B_RECORD.size, work_dir, quarter)
+        c_sorter = ExternalSorter(C_RECORD.size, work_dir, quarter)
+
+        # 第一遍：扫描专利表，写出专利、后向引用边、前向引用边和焦点专利的直接前向引用
+        rows = db.query(
+            Patent.publication_number,
+            Patent.publication_date,
+            Patent.listed_company,
+            Patent.backward_citations,
+            Patent.forward_citations,
+        ).yield_per(FETCH_ROWS)
+        for pub, pub_date, listed_company, backward_citations, forward_citations in tqdm(rows, desc="扫描专利表"):
+            pub_key = pub_keys.pack(pub)
+            focus_date = pack_date(pub_date)
+            p_sorter.add(P_RECORD.pack(pub_key, focus_date))
+
+            forward_keys = [pub_keys.pack(x) for x in split_citations(forward_citations)]
+            for x_key in forward_keys:
+                b_sorter.add(B_RECORD.pack(pub_key, x_key))
+
+            if listed_company:
+                c_sorter.add(C_RECORD.pack(b"", pub_key, KIND_FOCUS, focus_date))
+                for x_key in forward_keys:
+                    c_sorter.add(C_RECORD.pack(x_key, pub_key, KIND_FORWARD, focus_date))
+                for b in split_citations(backward_citations):
+                    a_sorter.add(A_RECORD.pack(pub_keys.pack(b), pub_key, focus_date))
+
+        # 第二遍：按后向引用b连接，得到“后向引用的前向引用”
+        for b_key, (a_group, b_group, p_group) in tqdm(
+            join_by_key(PUB_WIDTH, a_sorter.sorted(quarter), b_sorter.sorted(quarter), p_sorter.sorted(quarter)),
+            desc="连接引用边",
+        ):
+            if not a_group:
+                continue
+            exists = bool(p_group)
+            for a_record in a_group:
+                _, focus_key, focus_date = A_RECORD.unpack(a_record)
+                if not exists:
+                    c_sorter.add(C_RECORD.pack(b_key, focus_key, KIND_MISSING, focus_date))
+                    continue
+                for b_record in b_group:
+                    _, x_key = B_RECORD.unpack(b_record)
+                    c_sorter.add(C_RECORD.pack(x_key, focus_key, KIND_BACKWARD_FORWARD, focus_date))
+
+        a_sorter.cleanup()
+        b_sorter.cleanup()
+
+        # 第三遍：按x连接专利表，补上x的发布日期
+        d_sorter = ExternalSorter(D_RECORD.size, work_dir, memory_budget // 2)
+        for _, (c_group, p_group) in tqdm(
+            join_by_key(PUB_WIDTH, c_sorter.sorted(quarter), p_sorter.sorted(quarter)), desc="补充日期"
+        ):
+            x_date = P_RECORD.unpack(p_group[0])[1] if p_group else 0
+            for c_record in c_group:
+                x_key, focus_key, kind, focus_date = C_RECORD.unpack(c_record)
+                d_sorter.add(D_RECORD.pack(focus_key, x_key, kind, focus_date, x_date))
+        c_sorter.cleanup()
+        p_sorter.cleanup()
+
+        # 第四遍：按焦点专利分组流式分类
+        for focus_key, records in groupby(d_sorter.sorted(memory_budget), key=lambda record: record[:PUB_WIDTH]):
+            focus_patent = pub_keys.unpack(focus_key)
+            forward_patents: set[str] = set()
+            forward_patents_of_backward_patents: set[str] = set()
+            dates: dict[str, int] = {}
+            missing: str | None = None
+            focus_date = 0
+            for record in records:
+                _, x_key, kind, focus_date, x_date = D_RECORD.unpack(record)
+                x = pub_keys.unpack(x_key)
+                if kind == KIND_MISSING:
+                    missing = x
+                elif kind == KIND_FORWARD:
+                    forward_patents.add(x)
+                elif kind == KIND_BACKWARD_FORWARD:
+                    forward_patents_of_backward_patents.add(x)
+                    dates[x] = x_date
+
+            if missing is not None:
+                logger.error(f"跳过专利 {focus_patent}: 专利 {missing} 不存在")
+                continue
+
+            b0f1 = forward_patents - forward_patents_of_backward_patents
+            b1f1 = forward_patents & forward_patents_of_backward_patents
+            # 对于b1f0专利，需要过滤掉发布日期早于或等于焦点专利的专利，焦点专利没有日期时不过滤
+            potential_b1f0 = forward_patents_of_backward_patents - forward_patents - {focus_patent}
+            b1f0 = {x for x in potential_b1f0 if dates[x] > focus_date} if focus_date else potential_b1f0
+            yield focus_patent, b1f0, b1f1, b0f1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
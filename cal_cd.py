@@ -1,29 +1,50 @@
 import argparse
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Iterable
+from functools import partial
 
 import requests
 
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.orm import Session
 from tenacity import retry, stop_after_attempt
 from tqdm import tqdm
 
 from db import SessionLocal, engine
+from db.codec import decode_patents
 from db.log import get_logger
-from db.models import Base, CDIndex, ExtendedInfo, Patent
+from db.models import STORAGE_MAPPING, Base, CDIndex, ExtendedInfo, ExtendedInfoCompact, Patent, SimilarityMemo
 
 
 logger = get_logger(__name__)
 
+SIMILARITY_URL = "http://if-dbepe3l7zwjuru36-service:80/similarity"
+SIMILARITY_BATCH_URL = SIMILARITY_URL + "/batch"
+SIMILARITY_BATCH_SIZE = 256  # 每次批量请求的候选摘要数，避免单个请求过大超时
+
 
 def count(patents: str) -> int:
     return len([p for p in patents.split(",") if p.strip()]) if patents else 0
 
 
+def get_counts(info: ExtendedInfo | ExtendedInfoCompact) -> tuple[int, int, int]:
+    """返回 b1f0, b1f1, b0f1 的数量，紧凑格式直接读取计数列"""
+    if isinstance(info, ExtendedInfoCompact):
+        return info.b1f0_count, info.b1f1_count, info.b0f1_count  # type: ignore[return-value]
+    return count(info.b1f0_patents), count(info.b1f1_patents), count(info.b0f1_patents)  # type: ignore
+
+
+def get_forward_patents(db: Session, info: ExtendedInfo | ExtendedInfoCompact) -> set[str]:
+    """返回 b1f1 与 b0f1 专利号的并集，即焦点专利的前向引用"""
+    if isinstance(info, ExtendedInfoCompact):
+        return decode_patents(db, info.b1f1_ids) | decode_patents(db, info.b0f1_ids)  # type: ignore[arg-type]
+    return {
+        p.strip() for group in (info.b1f1_patents, info.b0f1_patents) if group for p in group.split(",") if p.strip()
+    }
+
+
 @retry(stop=stop_after_attempt(5))
-def get_similarity(
-    sentence1: str, sentence2: str, url: str = "http://if-dbepe3l7zwjuru36-service:80/similarity"
-) -> float:
+def get_similarity(sentence1: str, sentence2: str, url: str = SIMILARITY_URL) -> float:
     payload = {
         "sentence1": sentence1,
         "sentence2": sentence2,
@@ -38,11 +59,80 @@ def get_similarity(
         raise ValueError(f"请求失败，状态码: {resp.status_code}, 响应内容: {resp.text}")
 
 
-def cal_cd_t(db: Session, info: ExtendedInfo) -> float | None:
+@retry(stop=stop_after_attempt(5))
+def get_batch_similarity(sentence: str, candidates: list[str], url: str = SIMILARITY_BATCH_URL) -> list[float]:
+    """一次请求计算 sentence 与多个候选句子的相似度，sentence 只需编码一次"""
+    payload = {
+        "sentence": sentence,
+        "candidates": candidates,
+    }
+    headers = {"Content-Type": "application/json"}
+
+    resp = requests.post(url, json=payload, headers=headers, timeout=120)
+    if resp.status_code == 200:
+        data = resp.json()
+        return data["similarities"]
+    else:
+        raise ValueError(f"请求失败，状态码: {resp.status_code}, 响应内容: {resp.text}")
+
+
+def get_similarity_model_id(url: str = SIMILARITY_URL) -> str:
+    """从相似度服务的 /ready 接口获取当前模型标识（模型名称@权重版本:推理后端）"""
+    resp = requests.get(url.rsplit("/", 1)[0] + "/ready", timeout=5)
+    if resp.status_code == 200:
+        return resp.json()["model"]
+    else:
+        raise ValueError(f"相似度服务未就绪，状态码: {resp.status_code}, 响应内容: {resp.text}")
+
+
+def get_memo_similarities(db: Session, model_id: str, focus_patent: str, patents: Iterable[str]) -> dict[str, float]:
+    """批量查询已缓存的相似度"""
+    patent_list = list(patents)
+    chunk_size = 10000  # 避免 SQL 过长
+    similarities: dict[str, float] = {}
+    for i in range(0, len(patent_list), chunk_size):
+        rows = (
+            db.query(SimilarityMemo.citing_publication_number, SimilarityMemo.similarity)
+            .filter(
+                SimilarityMemo.model_id == model_id,
+                SimilarityMemo.focus_publication_number == focus_patent,
+                SimilarityMemo.citing_publication_number.in_(patent_list[i : i + chunk_size]),
+            )
+            .all()
+        )
+        similarities.update((pub, sim) for pub, sim in rows)
+    return similarities
+
+
+def save_memo_similarities(model_id: str, focus_patent: str, similarities: dict[str, float]):
+    """
+    批量写入新计算的相似度，已存在的跳过；使用独立事务立即提交，不随 cd_index 的批量提交，
+    进程被杀等情况下已算出的相似度也不会丢失
+    """
+    if not similarities:
+        return
+    insert_stmt = insert(SimilarityMemo).values(
+        [
+            {
+                "model_id": model_id,
+                "focus_publication_number": focus_patent,
+                "citing_publication_number": pub,
+                "similarity": sim,
+            }
+            for pub, sim in similarities.items()
+        ]
+    )
+    # 只跳过主键重复的行；不用 INSERT IGNORE，以免把超长等错误降级为警告并截断写入
+    insert_stmt = insert_stmt.on_duplicate_key_update(model_id=insert_stmt.table.c.model_id)
+    with engine.begin() as conn:
+        conn.execute(insert_stmt)
+
+
+def cal_cd_t(db: Session, info: ExtendedInfo | ExtendedInfoCompact) -> float | None:
     def sub_formula(b: int, f: int, w: int = 1) -> float:
         return (-2 * f * b + f) / w
 
-    len_b1f0, len_b1f1, len_b0f1 = count(info.b1f0_patents), count(info.b1f1_patents), count(info.b0f1_patents)  # type: ignore
+    len_b1f0, len_b1f1, len_b0f1 = get_counts(info)
     cd = len_b1f0 * sub_formula(1, 0) + len_b1f1 * sub_formula(1, 1) + len_b0f1 * sub_formula(0, 1)
     if len_b1f0 + len_b1f1 + len_b0f1 != 0:
         return cd / (len_b1f0 + len_b1f1 + len_b0f1)
@@ -50,11 +140,11 @@ def cal_cd_t(db: Session, info: ExtendedInfo) -> float | None:
         return None
 
 
-def cal_cd_f_t(db: Session, info: ExtendedInfo) -> float | None:
+def cal_cd_f_t(db: Session, info: ExtendedInfo | ExtendedInfoCompact) -> float | None:
     def sub_formula(b: int, f: int, w: int = 1) -> float:
         return (f * (-f * b + 2 * f) - 1) / w
 
-    len_b1f0, len_b1f1, len_b0f1 = count(info.b1f0_patents), count(info.b1f1_patents), count(info.b0f1_patents)  # type: ignore
+    len_b1f0, len_b1f1, len_b0f1 = get_counts(info)
     cd = len_b1f0 * sub_formula(1, 0) + len_b1f1 * sub_formula(1, 1) + len_b0f1 * sub_formula(0, 1)
     if len_b1f0 + len_b1f1 + len_b0f1 != 0:
         return cd / (len_b1f0 + len_b1f1 + len_b0f1)
@@ -62,11 +152,11 @@ def cal_cd_f_t(db: Session, info: ExtendedInfo) -> float | None:
         return None
 
 
-def cal_cd_f2_t(db: Session, info: ExtendedInfo) -> float | None:
+def cal_cd_f2_t(db: Session, info: ExtendedInfo | ExtendedInfoCompact) -> float | None:
     def sub_formula(b: int, f: int, w: int = 1) -> float:
         return (f * (-f * b + 2 * f) - 1) / w
 
-    len_b1f0, len_b1f1, len_b0f1 = count(info.b1f0_patents), count(info.b1f1_patents), count(info.b0f1_patents)  # type: ignore
+    len_b1f0, len_b1f1, len_b0f1 = get_counts(info)
     cd = len_b1f0 * sub_formula(1, 0) + len_b1f1 * sub_formula(1, 1) + len_b0f1 * sub_formula(0, 1)
     if len_b1f0 + len_b1f1 + len_b0f1 != 0:
         return cd / (len_b1f0 + len_b1f1 + len_b0f1) * (len_b1f1 + len_b0f1)
@@ -74,9 +164,7 @@ def cal_cd_f2_t(db: Session, info: ExtendedInfo) -> float | None:
         return None
 
 
-def cal_cd_f3_t(db: Session, info: ExtendedInfo) -> float | None:
-    max_workers = 16  # 并发线程数
-
+def cal_cd_f3_t(db: Session, info: ExtendedInfo | ExtendedInfoCompact, model_id: str) -> float | None:
     def get_abstract(patent: str | list[str] | set[str]) -> dict[str, str]:
         if isinstance(patent, str):
             patent = [patent]
@@ -95,23 +183,22 @@ def cal_cd_f3_t(db: Session, info: ExtendedInfo) -> float | None:
     if focus_patent_abs == "":
         return None
 
-    forward_patents = {
-        p.strip() for group in (info.b1f1_patents, info.b0f1_patents) if group for p in group.split(",") if p.strip()
-    }
+    forward_patents = get_forward_patents(db, info)
     forward_patents_abs = get_abstract(forward_patents)
     forward_patents_abs = {k: v for k, v in forward_patents_abs.items() if v}
 
-    # 并发计算相似度
-    cos_similarities: list[float] = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_patent = {
-            executor.submit(get_similarity, focus_patent_abs, abstract): pub
-            for pub, abstract in forward_patents_abs.items()
-        }
-        for future in as_completed(future_to_patent):
-            sim = future.result()
-            if sim is not None:
-                cos_similarities.append(sim)
+    # 先查缓存，缺失的专利对通过批量接口计算，焦点专利摘要每批只编码一次
+    memo_similarities = get_memo_similarities(db, model_id, focus_patent, forward_patents_abs)  # type: ignore[arg-type]
+    missing = [(pub, abstract) for pub, abstract in forward_patents_abs.items() if pub not in memo_similarities]
+    new_similarities: dict[str, float] = {}
+    for start in range(0, len(missing), SIMILARITY_BATCH_SIZE):
+        batch = missing[start : start + SIMILARITY_BATCH_SIZE]
+        scores = get_batch_similarity(focus_patent_abs, [abstract for _, abstract in batch])  # type: ignore[arg-type]
+        similarities = {pub: score for (pub, _), score in zip(batch, scores, strict=True)}
+        # 每批算完立即保存，中途出错时已算出的相似度不会丢失，重跑时不必再算
+        save_memo_similarities(model_id, focus_patent, similarities)  # type: ignore[arg-type]
+        new_similarities.update(similarities)
+    cos_similarities = [*memo_similarities.values(), *new_similarities.values()]
     if not cos_similarities:
         return None
 
@@ -122,11 +209,23 @@ def cal_cd_f3_t(db: Session, info: ExtendedInfo) -> float | None:
 CAL_CD_MAPPING = {"cd_t": cal_cd_t, "cd_f_t": cal_cd_f_t, "cd_f2_t": cal_cd_f2_t, "cd_f3_t": cal_cd_f3_t}
 
 
-def cal_cd(db: Session, index_names: str, batch_size: int):
+def cal_cd(
+    db: Session, index_names: str, batch_size: int, storage: str = "text", similarity_model_id: str | None = None
+):
+    info_model = STORAGE_MAPPING[storage]
+    cal_cd_mapping = dict(CAL_CD_MAPPING)
+    if "cd_f3_t" in index_names.split(","):
+        similarity_model_id = similarity_model_id or get_similarity_model_id()
+        max_length = SimilarityMemo.model_id.type.length
+        if len(similarity_model_id) > max_length:
+            # 截断后不同模型可能共用同一个标识，读到彼此缓存的相似度
+            raise ValueError(f"相似度模型标识 {similarity_model_id} 超过 {max_length} 个字符")
+        logger.info(f"相似度模型：{similarity_model_id}")
+        cal_cd_mapping["cd_f3_t"] = partial(cal_cd_f3_t, model_id=similarity_model_id)
     p_bar: tqdm = tqdm(desc=f"计算{index_names}中")
     offset = 0
     while True:
-        info_batch = db.query(ExtendedInfo).offset(offset).limit(batch_size).all()
+        info_batch: list = db.query(info_model).offset(offset).limit(batch_size).all()
         if not info_batch:
             break
 
@@ -140,7 +239,7 @@ def cal_cd(db: Session, index_names: str, batch_size: int):
                     current_val = getattr(cd_index, index_name, None)
                     if current_val is not None:
                         continue
-                    cd_value = CAL_CD_MAPPING[index_name](db, info)
+                    cd_value = cal_cd_mapping[index_name](db, info)
                     setattr(cd_index, index_name, cd_value)
                 except Exception as e:
                     logger.error(f"计算专利 {info.publication_number} 的 {index_name} 时出错: {e}")
@@ -155,11 +254,13 @@ if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("--index-names", required=True)
     arg_parser.add_argument("--batch-size", type=int, default=10000)
+    arg_parser.add_argument("--storage", choices=list(STORAGE_MAPPING.keys()), default="text")
+    arg_parser.add_argument("--similarity-model-id", help="相似度缓存使用的模型标识，默认从相似度服务获取")
     args = arg_parser.parse_args()
     if not all(index_name in CAL_CD_MAPPING for index_name in args.index_names.split(",")):
         raise ValueError(f"包含不支持的指数名称 {args.index_names}，支持的名称有 {list(CAL_CD_MAPPING.keys())}")
     logger.info(f"开始计算CD指数，运行参数：{args}")
     db: Session = SessionLocal()
-    cal_cd(db, args.index_names, args.batch_size)
+    cal_cd(db, args.index_names, args.batch_size, args.storage, args.similarity_model_id)
     db.close()
     logger.info("计算完成")
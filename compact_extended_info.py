@@ -0,0 +1,107 @@
+import argparse
+
+from sqlalchemy.orm import Session
+from tqdm import tqdm
+
+from db import SessionLocal, engine
+from db.codec import encode_ids, get_patent_ids
+from db.log import get_logger
+from db.models import Base, ExtendedInfo, ExtendedInfoCompact
+
+
+logger = get_logger(__name__)
+
+
+def split_patents(patents: str | None) -> set[str]:
+    # 去空白、去空项
+    if not patents:
+        return set()
+    return {p.strip() for p in patents.split(",") if p.strip()}
+
+
+def compact_extended_info(db: Session, batch_size: int, delete_text: bool):
+    """
+    把已有的 extended_info 文本行转换为 extended_info_compact，不必重新计算 b1f0, b1f1, b0f1；
+    已转换的行跳过，中断后可直接重跑。delete_text 时每批转换提交后删除对应的文本行
+    """
+    total = db.query(ExtendedInfo).count()
+    logger.info(f"待转换行数: {total}")
+
+    last_publication_number = ""
+    converted = 0
+    with tqdm(total=total) as pbar:
+        while True:
+            # 按专利号分页，删除已转换的文本行不影响后续分页
+            infos = (
+                db.query(ExtendedInfo)
+                .filter(ExtendedInfo.publication_number > last_publication_number)
+                .order_by(ExtendedInfo.publication_number)
+                .limit(batch_size)
+                .all()
+            )
+            if not infos:
+                break
+            last_publication_number = infos[-1].publication_number  # type: ignore[assignment]
+            publication_numbers = [info.publication_number for info in infos]
+
+            existing = {
+                row[0]
+                for row in db.query(ExtendedInfoCompact.publication_number)
+                .filter(ExtendedInfoCompact.publication_number.in_(publication_numbers))
+                .all()
+            }
+            groups = {
+                info.publication_number: [
+                    split_patents(info.b1f0_patents),  # type: ignore[arg-type]
+                    split_patents(info.b1f1_patents),  # type: ignore[arg-type]
+                    split_patents(info.b0f1_patents),  # type: ignore[arg-type]
+                ]
+                for info in infos
+                if info.publication_number not in existing
+            }
+            # 整批一起分配id，减少查询次数
+            ids = get_patent_ids(db, {p for patent_sets in groups.values() for patents in patent_sets for p in patents})
+
+            for publication_number, (b1f0, b1f1, b0f1) in groups.items():
+                # 数量与文本格式一致，包含无法分配id的专利号，与 encode_patents 相同
+                db.add(
+                    ExtendedInfoCompact(
+                        publication_number=publication_number,
+                        b1f0_count=len(b1f0),
+                        b1f1_count=len(b1f1),
+                        b0f1_count=len(b0f1),
+                        b1f0_ids=encode_ids(ids[p] for p in b1f0 if p in ids),
+                        b1f1_ids=encode_ids(ids[p] for p in b1f1 if p in ids),
+                        b0f1_ids=encode_ids(ids[p] for p in b0f1 if p in ids),
+                    )
+                )
+            db.commit()
+            converted += len(groups)
+
+            if delete_text:
+                db.query(ExtendedInfo).filter(ExtendedInfo.publication_number.in_(publication_numbers)).delete(
+                    synchronize_session=False
+                )
+                db.commit()
+            pbar.update(len(infos))
+
+    logger.info(f"共转换 {converted} 行，跳过已转换的 {total - converted} 行")
+    if delete_text:
+        # InnoDB 删除行后不会自动归还磁盘空间
+        logger.info("文本行已删除，可执行 OPTIMIZE TABLE extended_info 回收磁盘空间")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="把 extended_info 的文本行转换为压缩格式 extended_info_compact")
+    arg_parser.add_argument("--batch-size", type=int, default=1000)
+    arg_parser.add_argument("--delete-text", action="store_true", help="转换后删除 extended_info 中对应的文本行")
+    args = arg_parser.parse_args()
+    logger.info(f"开始转换，运行参数：{args}")
+
+    # Create tables if they do not exist
+    Base.metadata.create_all(bind=engine)
+
+    session = SessionLocal()
+    compact_extended_info(session, args.batch_size, args.delete_text)
+    session.close()
+    logger.info("转换完成")
@@ -0,0 +1,121 @@
+from collections.abc import Iterable
+
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.orm import Session
+
+from .log import get_logger
+from .models import PatentId
+
+
+logger = get_logger(__name__)
+
+CHUNK_SIZE = 10000  # 避免 SQL 过长
+
+
+def encode_ids(ids: Iterable[int]) -> bytes:
+    """
+    将整数id集合编码为字节串：先排序去重，再做差分，最后用 varint (LEB128) 压缩
+    """
+    buf = bytearray()
+    prev = 0
+    for value in sorted(set(ids)):
+        if value < 0:
+            raise ValueError(f"id 不能为负数: {value}")
+        delta = value - prev
+        prev = value
+        while delta >= 0x80:
+            buf.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        buf.append(delta)
+    return bytes(buf)
+
+
+def decode_ids(data: bytes | None) -> list[int]:
+    """
+    encode_ids 的逆过程，返回升序的整数id列表
+    """
+    ids: list[int] = []
+    if not data:
+        return ids
+
+    prev = 0
+    delta = 0
+    shift = 0
+    for byte in data:
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        prev += delta
+        ids.append(prev)
+        delta = 0
+        shift = 0
+    if shift:
+        raise ValueError("varint 数据被截断")
+    return ids
+
+
+def get_patent_ids(db: Session, patents: Iterable[str]) -> dict[str, int]:
+    """
+    获取专利号对应的整数id，不存在的专利号会先分配新id；超过列长度的专利号无法保存，记录警告后跳过
+    """
+    max_length = PatentId.publication_number.type.length
+    patent_list = []
+    for pub in set(patents):
+        if len(pub) > max_length:
+            logger.warning(f"专利号 {pub} 超过 {max_length} 个字符，无法分配id")
+        else:
+            patent_list.append(pub)
+
+    mapping: dict[str, int] = {}
+    for i in range(0, len(patent_list), CHUNK_SIZE):
+        chunk = patent_list[i : i + CHUNK_SIZE]
+        rows = db.query(PatentId.publication_number, PatentId.id).filter(PatentId.publication_number.in_(chunk)).all()
+        mapping.update((pub, id_) for pub, id_ in rows)
+
+        # 只插入缺失的专利号：被忽略的重复插入同样会消耗 AUTO_INCREMENT 值，使id变稀疏
+        missing = [pub for pub in chunk if pub not in mapping]
+        if missing:
+            insert_stmt = insert(PatentId).values([{"publication_number": pub} for pub in missing])
+            db.execute(insert_stmt.prefix_with("IGNORE"))  # 仅用于应对并发分配同一专利号
+            rows = (
+                db.query(PatentId.publication_number, PatentId.id)
+                .filter(PatentId.publication_number.in_(missing))
+                .all()
+            )
+            mapping.update((pub, id_) for pub, id_ in rows)
+    return mapping
+
+
+def get_publication_numbers(db: Session, ids: Iterable[int]) -> dict[int, str]:
+    """
+    获取整数id对应的专利号
+    """
+    id_list = list(set(ids))
+    mapping: dict[int, str] = {}
+    for i in range(0, len(id_list), CHUNK_SIZE):
+        chunk = id_list[i : i + CHUNK_SIZE]
+        rows = db.query(PatentId.id, PatentId.publication_number).filter(PatentId.id.in_(chunk)).all()
+        mapping.update((id_, pub) for id_, pub in rows)
+    return mapping
+
+
+def encode_patents(db: Session, patents: Iterable[str]) -> tuple[int, bytes]:
+    """
+    将专利号集合编码为 (数量, 压缩后的id数组)；数量与文本格式一致，包含无法分配id的专利号
+    """
+    patent_set = set(patents)
+    ids = get_patent_ids(db, patent_set)
+    return len(patent_set), encode_ids(ids.values())
+
+
+def decode_patents(db: Session, data: bytes | None) -> set[str]:
+    """
+    将压缩后的id数组解码为专利号集合
+    """
+    ids = decode_ids(data)
+    mapping = get_publication_numbers(db, ids)
+    missing = [id_ for id_ in ids if id_ not in mapping]
+    if missing:
+        raise ValueError(f"找不到 {len(missing)} 个专利id对应的专利号，例如 {missing[:5]}")
+    return set(mapping.values())
@@ -1,4 +1,16 @@
-from sqlalchemy import DECIMAL, Boolean, Column, Date, ForeignKey, String, Text
+from sqlalchemy import (
+    DECIMAL,
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    Double,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+)
 
 from . import Base
 
@@ -27,6 +39,31 @@ class ExtendedInfo(Base):
     b0f1_patents = Column(Text)
 
 
+class PatentId(Base):
+    __tablename__ = "patent_id"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    publication_number = Column(String(20), unique=True, nullable=False)
+
+
+class ExtendedInfoCompact(Base):
+    """ExtendedInfo 的紧凑存储格式：专利列表保存为差分 + varint 压缩的 PatentId 数组，见 db/codec.py"""
+
+    __tablename__ = "extended_info_compact"
+
+    publication_number = Column(String(20), ForeignKey("patent.publication_number"), primary_key=True)
+    b1f0_count = Column(Integer, nullable=False, default=0)
+    b1f1_count = Column(Integer, nullable=False, default=0)
+    b0f1_count = Column(Integer, nullable=False, default=0)
+    b1f0_ids = Column(LargeBinary(2**24 - 1))  # MySQL 中为 MEDIUMBLOB
+    b1f1_ids = Column(LargeBinary(2**24 - 1))
+    b0f1_ids = Column(LargeBinary(2**24 - 1))
+
+
+# b1f0, b1f1, b0f1 的存储格式：逗号分隔文本或压缩id数组
+STORAGE_MAPPING = {"text": ExtendedInfo, "compact": ExtendedInfoCompact}
+
+
 class PatentMissing(Base):
     __tablename__ = "patent_missing"
 
@@ -41,3 +78,14 @@ class CDIndex(Base):
     cd_f_t = Column(DECIMAL(18, 6), default=None)  # type: ignore
     cd_f2_t = Column(DECIMAL(18, 6), default=None)  # type: ignore
     cd_f3_t = Column(DECIMAL(18, 6), default=None)  # type: ignore
+
+
+class SimilarityMemo(Base):
+    """(焦点专利, 引用焦点专利的专利) 摘要相似度的缓存，按模型区分，更换模型后旧结果自然失效"""
+
+    __tablename__ = "similarity_memo"
+
+    model_id = Column(String(128), primary_key=True)  # 模型名称@权重版本:推理后端
+    focus_publication_number = Column(String(20), primary_key=True)
+    citing_publication_number = Column(String(20), primary_key=True)
+    similarity = Column(Double, nullable=False)
@@ -0,0 +1,336 @@
+import argparse
+import csv
+import json
+import os
+
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import pairwise
+
+from more_itertools import peekable
+from sqlalchemy import Column, Connection, Date, MetaData, String, Table, Text, literal, select
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import DBAPIError
+from tqdm import tqdm
+
+from data2db import DataField, parse_abstract, parse_date, simplify_row
+from db import engine
+from db.log import get_logger
+from db.models import Base, Patent
+
+
+logger = get_logger(__name__)
+
+MYSQL_TEXT_MAX_BYTES = 65535  # MySQL TEXT 类型的最大字节数
+
+STAGING_COLUMNS = [
+    "publication_number",
+    "publication_date",
+    "patent_office",
+    "application_filing_date",
+    "applicants_bvd_id_numbers",
+    "backward_citations",
+    "forward_citations",
+    "abstract",
+]
+
+
+@dataclass
+class Source:
+    csv_file: str
+    field: DataField
+    listed_company: bool
+    shards: int
+
+
+@dataclass
+class Shard:
+    source_index: int
+    shard_index: int
+    csv_file: str
+    start: int  # 分片起始字节（含）
+    end: int  # 分片结束字节（不含）
+    field: DataField
+
+    @property
+    def table_name(self) -> str:
+        return f"patent_staging_{self.source_index}_{self.shard_index}"
+
+
+def staging_table(name: str) -> Table:
+    """暂存表，与 patent 表结构相同，但不含 listed_company 字段（合并时按来源填写）"""
+    return Table(
+        name,
+        MetaData(),
+        Column("publication_number", String(20), primary_key=True),
+        Column("publication_date", Date),
+        Column("patent_office", String(10)),
+        Column("application_filing_date", Date),
+        Column("applicants_bvd_id_numbers", String(40)),
+        Column("backward_citations", Text),
+        Column("forward_citations", Text),
+        Column("abstract", Text),
+    )
+
+
+def read_header(csv_file: str) -> tuple[list[str], int]:
+    """读取表头，返回表头字段和表头之后的字节位置（假设表头只占一行）"""
+    with open(csv_file, "rb") as f:
+        header_line = f.readline()
+        offset = f.tell()
+    header = next(csv.reader([header_line.decode("utf-8-sig")]))
+    return header, offset
+
+
+def iter_lines(csv_file: str, start: int, end: int) -> Iterator[str]:
+    """逐行读取 [start, end) 字节区间内的文本"""
+    with open(csv_file, "rb") as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode("utf-8")
+
+
+def is_patent_start(csv_file: str, offset: int, header: list[str], field: DataField) -> bool:
+    """判断 offset 处是否为一条专利的起始行：字段数量正确、专利号非空、日期可解析"""
+    reader = csv.DictReader(iter_lines(csv_file, offset, os.path.getsize(csv_file)), fieldnames=header)
+    row = next(reader, None)
+    if row is None or None in row or any(v is None for v in row.values()):
+        return False
+    if row[field.publication_number].strip() == "":
+        return False
+    try:
+        parse_date(row[field.publication_date])
+    except ValueError:
+        return False
+    return True
+
+
+def split_shards(source_index: int, source: Source) -> list[Shard]:
+    """按字节把一个CSV切成若干分片，分片边界对齐到专利起始行，保证后继引用行与其专利在同一分片"""
+    header, data_start = read_header(source.csv_file)
+    file_size = os.path.getsize(source.csv_file)
+
+    boundaries = [data_start]
+    with open(source.csv_file, "rb") as f:
+        for i in range(1, source.shards):
+            f.seek(max(data_start + (file_size - data_start) * i // source.shards, boundaries[-1]))
+            f.readline()  # 丢弃可能不完整的一行
+            while (offset := f.tell()) < file_size:
+                if is_patent_start(source.csv_file, offset, header, source.field):
+                    break
+                f.readline()
+            if offset > boundaries[-1] and offset < file_size:
+                boundaries.append(offset)
+    boundaries.append(file_size)
+
+    return [
+        Shard(source_index, shard_index, source.csv_file, start, end, source.field)
+        for shard_index, (start, end) in enumerate(pairwise(boundaries))
+    ]
+
+
+def iter_patents(shard: Shard) -> Iterator[dict[str, str]]:
+    """按 data2db 的规则，把专利行与其后继引用行合并为一条完整专利"""
+    field = shard.field
+    header, _ = read_header(shard.csv_file)
+    reader = peekable(csv.DictReader(iter_lines(shard.csv_file, shard.start, shard.end), fieldnames=header))
+    while first_row := next(reader, None):
+        # 跳过最初的无专利行
+        if first_row[field.publication_number].strip() == "":
+            logger.info(f"跳过无专利后继引用行：{simplify_row(first_row, field)}")
+            continue
+
+        while row := reader.peek(None):
+            if row[field.publication_number].strip() != "":
+                break  # 遇到新专利行了，退出内层循环
+            next(reader)  # 消耗该行
+
+            f_citation = row[field.forward_citations].strip()
+            if f_citation not in first_row[field.forward_citations]:
+                first_row[field.forward_citations] += f",{f_citation}"
+            b_citation = row[field.backward_citations].strip()
+            if b_citation not in first_row[field.backward_citations]:
+                first_row[field.backward_citations] += f",{b_citation}"
+
+        yield first_row
+
+
+def check_lengths(table: Table, row: dict) -> dict:
+    """
+    检查字段长度，超长时抛出 ValueError；与 data2db 中严格模式下插入失败、跳过该专利的行为一致
+    """
+    for column in table.columns:
+        value = row[column.name]
+        if not isinstance(value, str):
+            continue
+        if isinstance(column.type, Text):
+            if len(value.encode("utf-8")) > MYSQL_TEXT_MAX_BYTES:
+                raise ValueError(f"字段 {column.name} 超过 {MYSQL_TEXT_MAX_BYTES} 字节")
+        elif isinstance(column.type, String) and len(value) > column.type.length:
+            raise ValueError(f"字段 {column.name} 超过 {column.type.length} 个字符")
+    return row
+
+
+def insert_skip_duplicates(table):
+    """只跳过主键重复的行；不用 INSERT IGNORE，以免把超长等错误降级为警告并截断写入"""
+    insert_stmt = insert(table)
+    return insert_stmt.on_duplicate_key_update(publication_number=insert_stmt.table.c.publication_number)
+
+
+def insert_rows(conn: Connection, insert_stmt, rows: list[dict]) -> int:
+    """
+    批量写入，失败时回滚并逐行重试，与 data2db 一样跳过写入失败的专利；返回写入成功的行数。
+    数据库连接断开时直接抛出，不逐行重试
+    """
+    try:
+        conn.execute(insert_stmt, rows)
+        conn.commit()
+        return len(rows)
+    except DBAPIError as e:
+        conn.rollback()
+        if e.connection_invalidated:
+            raise
+        logger.warning(f"批量写入 {len(rows)} 条专利失败，改为逐行写入 - {e.orig}")
+
+    patent_count = 0
+    for row in rows:
+        try:
+            conn.execute(insert_stmt, row)
+            conn.commit()
+            patent_count += 1
+        except DBAPIError as e:
+            conn.rollback()
+            if e.connection_invalidated:
+                raise
+            logger.error(f"跳过完整专利 {row['publication_number']} - {e}")
+    return patent_count
+
+
+def load_shard(shard: Shard, batch_size: int) -> int:
+    """把一个分片导入其暂存表；分片内重复的专利以先出现者为准"""
+    field = shard.field
+    table = staging_table(shard.table_name)
+    insert_stmt = insert_skip_duplicates(table)
+    patent_count = 0
+    rows: list[dict] = []
+    with engine.connect() as conn:
+        for first_row in iter_patents(shard):
+            try:
+                rows.append(
+                    check_lengths(
+                        table,
+                        {
+                            "publication_number": first_row[field.publication_number].strip(),
+                            "publication_date": parse_date(first_row[field.publication_date].strip()),
+                            "patent_office": first_row[field.patent_office].strip(),
+                            "application_filing_date": parse_date(first_row[field.application_filing_date].strip()),
+                            "applicants_bvd_id_numbers": first_row[field.applicants_bvd_id_numbers].strip(),
+                            "backward_citations": first_row[field.backward_citations].strip(),
+                            "forward_citations": first_row[field.forward_citations].strip(),
+                            "abstract": parse_abstract(first_row[field.abstract]),
+                        },
+                    )
+                )
+            except ValueError as e:
+                logger.error(f"跳过完整专利 {simplify_row(first_row, field)} - {e}")
+                continue
+
+            if len(rows) >= batch_size:
+                patent_count += insert_rows(conn, insert_stmt, rows)
+                rows = []
+        if rows:
+            patent_count += insert_rows(conn, insert_stmt, rows)
+    return patent_count
+
+
+def init_worker():
+    # 子进程不能复用父进程的数据库连接
+    engine.dispose(close=False)
+
+
+def merge_staging(shards: list[Shard], sources: list[Source]) -> None:
+    """按来源和分片顺序把暂存表合并到 patent 表，先合并者优先，重复专利跳过"""
+    for shard in sorted(shards, key=lambda s: (s.source_index, s.shard_index)):
+        table = staging_table(shard.table_name)
+        listed_company = 1 if sources[shard.source_index].listed_company else 0
+        insert_stmt = insert_skip_duplicates(Patent.__table__).from_select(
+            [*STAGING_COLUMNS, "listed_company"],
+            select(*[table.c[name] for name in STAGING_COLUMNS], literal(listed_company)),
+        )
+        with engine.begin() as conn:
+            result = conn.execute(insert_stmt)
+        logger.info(f"暂存表 {shard.table_name} 合并完成，新增 {result.rowcount} 条专利")
+
+
+def ingest(sources: list[Source], workers: int, batch_size: int, keep_staging: bool, resume: bool) -> None:
+    """
+    导入失败时保留暂存表，便于排查；以 resume 重跑时沿用已有暂存表，已导入的专利按主键重复跳过
+    （分片边界由文件内容决定，同一配置重跑时不变）
+    """
+    shards = [shard for source_index, source in enumerate(sources) for shard in split_shards(source_index, source)]
+    logger.info(f"共 {len(sources)} 个文件，切分为 {len(shards)} 个分片")
+
+    tables = [staging_table(shard.table_name) for shard in shards]
+    for table in tables:
+        if not resume:
+            table.drop(engine, checkfirst=True)
+        table.create(engine, checkfirst=True)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            future_to_shard = {executor.submit(load_shard, shard, batch_size): shard for shard in shards}
+            for future in tqdm(as_completed(future_to_shard), total=len(shards), desc="导入分片"):
+                shard = future_to_shard[future]
+                logger.info(f"分片 {shard.table_name} 导入完成，共 {future.result()} 条专利")
+
+        merge_staging(shards, sources)
+    except Exception:
+        logger.error("导入失败，已保留暂存表，排查后可加 --resume 重跑")
+        raise
+
+    if not keep_staging:
+        for table in tables:
+            table.drop(engine, checkfirst=True)
+
+
+def load_sources(config_file: str) -> list[Source]:
+    """
+    读取来源配置，格式为：
+    [{"csv_file": "...", "listed_company": true, "shards": 4, "columns": {"publication_number": "...", ...}}, ...]
+    """
+    with open(config_file, encoding="utf-8") as f:
+        config = json.load(f)
+    return [
+        Source(
+            csv_file=item["csv_file"],
+            field=DataField(**item["columns"]),
+            listed_company=item.get("listed_company", False),
+            shards=item.get("shards", 1),
+        )
+        for item in config
+    ]
+
+
+def get_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="通过分片暂存表并发导入多个CSV文件的专利数据")
+    parser.add_argument("--config", type=str, required=True, help="来源配置JSON文件路径，排在前面的来源优先")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="并发进程数")
+    parser.add_argument("--batch-size", type=int, default=10000, help="每次批量写入暂存表的专利数")
+    parser.add_argument("--keep-staging", action="store_true", help="合并后保留暂存表")
+    parser.add_argument("--resume", action="store_true", help="沿用上次失败时保留的暂存表继续导入")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger.info(f"执行并发导入操作，参数：{args}")
+
+    Base.metadata.create_all(bind=engine)
+
+    ingest(load_sources(args.config), args.workers, args.batch_size, args.keep_staging, args.resume)
+    logger.info("导入完成")
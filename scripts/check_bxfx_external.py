@@ -0,0 +1,91 @@
+"""
+检查 cal_bxfx_external.compute_bxfx 与 cal_bxfx.get_bxfx 的结果是否一致
+
+随机生成一个 sqlite 专利引用图，包含不存在的后向引用、缺失的发布日期和超过 PUB_WIDTH 字节的专利号，
+默认的内存预算很小，会产生大量顺段并触发分批归并：
+    python scripts/check_bxfx_external.py
+    python scripts/check_bxfx_external.py --patents 5000 --memory-budget 1048576 --seed 1
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from datetime import date, timedelta
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db 包导入时会按环境变量创建引擎，这里只需一个可用的地址，检查本身使用下面创建的临时 sqlite 数据库
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from cal_bxfx import get_bxfx
+from cal_bxfx_external import PUB_WIDTH, compute_bxfx
+from db.models import Patent
+
+
+def build_random_graph(db: Session, patent_count: int, rng: random.Random) -> None:
+    """随机生成专利及其前后向引用"""
+    pubs = [f"CN{i:09d}A" for i in range(patent_count)]
+    # 字符数不超过 20 但 UTF-8 编码超过 PUB_WIDTH 字节的专利号，确实存在于专利表中
+    pubs += [f"专利号专利号专利号专利号{i:03d}" for i in range(5)]
+    # 专利表中不存在的引用：普通的和超长的
+    missing = [f"US{i:09d}B" for i in range(20)]
+    too_long = [f"WO{i:03d}" + "X" * PUB_WIDTH for i in range(20)]
+    assert all(len(pub.encode("utf-8")) > PUB_WIDTH for pub in pubs[patent_count:])
+
+    def citations(count: int, extra: list[str]) -> str:
+        cited = rng.sample(pubs, count)
+        if rng.random() < 0.05:
+            cited.append(rng.choice(extra))
+        return ",".join(f" {x} " if rng.random() < 0.1 else x for x in cited)
+
+    start = date(2000, 1, 1)
+    for pub in pubs:
+        db.add(
+            Patent(
+                publication_number=pub,
+                publication_date=None if rng.random() < 0.05 else start + timedelta(days=rng.randrange(7000)),
+                listed_company=rng.random() < 0.5,
+                # 不存在的后向引用会使 get_bxfx 跳过焦点专利，比例不宜过高
+                backward_citations=citations(rng.randrange(4), missing + too_long) if rng.random() < 0.9 else None,
+                forward_citations=citations(rng.randrange(6), too_long),
+            )
+        )
+    db.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="检查外部排序与逐个查询计算的 b1f0, b1f1, b0f1 是否一致")
+    parser.add_argument("--patents", type=int, default=2000, help="随机生成的专利数")
+    parser.add_argument("--memory-budget", type=int, default=64 * 1024, help="外部排序的内存预算，单位字节")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'patent.db')}")
+        Patent.__table__.create(engine)
+        with Session(engine) as db:
+            build_random_graph(db, args.patents, random.Random(args.seed))
+
+            expected = {}
+            for (pub,) in db.query(Patent.publication_number).filter(Patent.listed_company):
+                try:
+                    expected[pub] = get_bxfx(db, pub)
+                except ValueError:
+                    continue
+            actual = {
+                pub: (b1f0, b1f1, b0f1)
+                for pub, b1f0, b1f1, b0f1 in compute_bxfx(db, os.path.join(tmp_dir, "bxfx"), args.memory_budget)
+            }
+        engine.dispose()
+
+    mismatched = sorted(pub for pub in expected.keys() | actual.keys() if expected.get(pub) != actual.get(pub))
+    for pub in mismatched[:10]:
+        print(f"{pub}: get_bxfx {expected.get(pub)}，compute_bxfx {actual.get(pub)}")
+    print(f"焦点专利 {len(expected)} 个，不一致 {len(mismatched)} 个，{'通过' if not mismatched else '失败'}")
+    sys.exit(1 if mismatched else 0)
@@ -0,0 +1,117 @@
+"""
+检查 serve_jina_cos 各推理后端的相似度结果是否一致
+
+默认随机初始化一个极小的 BertModel 并导出 onnx，无需下载模型：
+    python scripts/check_serve_backends.py
+也可以指定真实模型（onnx 后端需要模型目录下有 onnx/model.onnx）：
+    python scripts/check_serve_backends.py --model-path /mnt/public/model/huggingface/jina-embeddings-v3
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SENTENCES = [
+    "a method for encoding patent citations",
+    "patent citation encoding method",
+    "hello world",
+    "a b c d e f g h i j k l m n o p q r s t u v w x y z",
+    "x",
+]
+
+
+def build_tiny_model(model_dir: str) -> None:
+    """随机初始化一个极小的 BertModel，保存模型、分词器，并导出 onnx/model.onnx"""
+    from transformers import BertConfig, BertModel, BertTokenizer  # type: ignore
+
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *"abcdefghijklmnopqrstuvwxyz", "patent", "citation"]
+    vocab_file = os.path.join(model_dir, "vocab.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab))
+    tokenizer = BertTokenizer(vocab_file)
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64
+    )
+    model = BertModel(config).eval()
+    model.save_pretrained(model_dir)
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, model: torch.nn.Module):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    inputs = tokenizer(SENTENCES[:2], padding=True, return_tensors="pt")
+    os.makedirs(os.path.join(model_dir, "onnx"), exist_ok=True)
+    torch.onnx.export(
+        LastHiddenState(model),
+        (inputs["input_ids"], inputs["attention_mask"]),
+        os.path.join(model_dir, "onnx", "model.onnx"),
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "last_hidden_state": {0: "batch", 1: "sequence"},
+        },
+        dynamo=False,
+    )
+
+
+def similarity_matrix(model_path: str, backend: str) -> np.ndarray:
+    """按给定后端重新加载 serve_jina_cos，计算 SENTENCES 两两之间的相似度"""
+    os.environ["JINA_MODEL_PATH"] = model_path
+    os.environ["JINA_BACKEND"] = backend
+    os.environ["JINA_DEVICE"] = "cpu"
+    os.environ["JINA_BATCH_SIZE"] = "2"  # 小批量，覆盖按长度排序后分批再恢复顺序的逻辑
+    import serve_jina_cos
+
+    serve_jina_cos = importlib.reload(serve_jina_cos)
+    embeddings = serve_jina_cos.load_backend().encode(SENTENCES)
+    return np.array([[serve_jina_cos.cosine_similarity(a, b) for b in embeddings] for a in embeddings])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="检查 serve_jina_cos 各推理后端的相似度结果是否一致")
+    parser.add_argument("--model-path", type=str, help="模型目录，默认构造一个极小的随机模型")
+    parser.add_argument("--backends", type=str, default="torch,torch-int8,onnx")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="fp32 后端与 torch 的最大允许误差")
+    parser.add_argument("--int8-tolerance", type=float, default=2e-2, help="torch-int8 与 torch 的最大允许误差")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = args.model_path
+        if model_path is None:
+            model_path = tmp_dir
+            build_tiny_model(model_path)
+
+        reference = similarity_matrix(model_path, "torch")
+        failed = False
+        for backend in args.backends.split(","):
+            if backend == "torch":
+                continue
+            try:
+                scores = similarity_matrix(model_path, backend)
+            except ValueError as e:
+                print(f"{backend}: 不可用 - {e}")
+                continue
+            max_diff = float(np.abs(scores - reference).max())
+            tolerance = args.int8_tolerance if backend == "torch-int8" else args.tolerance
+            ok = max_diff <= tolerance
+            failed = failed or not ok
+            print(f"{backend}: 与 torch 的最大误差 {max_diff:.2e}，允许 {tolerance:.0e}，{'通过' if ok else '失败'}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,9 @@
+#!/bin/bash
+set -exuo pipefail
+
+
+# 与 import_data.sh 导入相同的数据，但各文件分片并发导入暂存表后再合并
+python ingest.py \
+  --config "scripts/ingest_sources.json" \
+  --workers 16 \
+  --batch-size 10000
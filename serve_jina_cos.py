@@ -1,17 +1,193 @@
+import hashlib
+import os
+import threading
+
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, suppress
+from glob import glob
+
 import numpy as np
 import torch
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from transformers import AutoModel  # type: ignore
+from transformers import AutoConfig, AutoModel, AutoTokenizer  # type: ignore
+
+
+# 配置项，均可通过环境变量覆盖
+MODEL_PATH = os.getenv("JINA_MODEL_PATH", "jinaai/jina-embeddings-v3")  # 本地目录或 HuggingFace 模型名
+MODEL_NAME = os.getenv("JINA_MODEL_ID", os.path.basename(MODEL_PATH.rstrip("/")))  # 对外报告的模型名称
+BACKEND = os.getenv("JINA_BACKEND", "torch")  # torch / torch-int8 / onnx
+DEVICE = os.getenv("JINA_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+NUM_THREADS = int(os.getenv("JINA_NUM_THREADS", "0"))  # CPU 推理线程数，0 表示使用默认值
+BATCH_SIZE = int(os.getenv("JINA_BATCH_SIZE", "32"))
+MAX_LENGTH = int(os.getenv("JINA_MAX_LENGTH", "8192"))
+ONNX_FILE = os.getenv("JINA_ONNX_FILE", "onnx/model.onnx")  # 相对于 MODEL_PATH 的 onnx 模型文件
+TASK = "text-matching"
+
+
+class EmbeddingBackend(ABC):
+    """推理后端基类，子类只需实现 encode_batch"""
+
+    @abstractmethod
+    def encode_batch(self, sentences: list[str]) -> np.ndarray: ...
+
+    def encode(self, sentences: list[str]) -> np.ndarray:
+        """按长度排序后分批编码，减少 padding，最后恢复原顺序"""
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+        embeddings: list[np.ndarray] = [np.empty(0)] * len(sentences)
+        for start in range(0, len(order), BATCH_SIZE):
+            batch = order[start : start + BATCH_SIZE]
+            for i, embedding in zip(batch, self.encode_batch([sentences[i] for i in batch]), strict=True):
+                embeddings[i] = embedding
+        return np.stack(embeddings)
+
+
+def mean_pooling(token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    mask = attention_mask[..., None].astype(token_embeddings.dtype)
+    return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+
+def quantize_linear(model: torch.nn.Module) -> torch.nn.Module:
+    """对普通 nn.Linear 做 int8 动态量化，跳过带 parametrization 的层"""
+    qconfig_spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if type(module) is torch.nn.Linear and not torch.nn.utils.parametrize.is_parametrized(module)
+    }
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+class TorchBackend(EmbeddingBackend):
+    def __init__(self, model_path: str, device: str, quantize: bool = False):
+        if quantize and device != "cpu":
+            raise ValueError(f"int8 动态量化仅支持 CPU，当前设备为 {device}")
+        if NUM_THREADS > 0:
+            torch.set_num_threads(NUM_THREADS)
+
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
+        if quantize:
+            # jina-embeddings 通过 nn.Linear 上的 parametrization 挂载任务 LoRA 适配器，量化后可能静默丢失适配器，
+            # 且尚未在真实模型上验证 int8 与 fp32 结果一致，因此拒绝量化；CPU 上请使用 onnx 后端
+            if hasattr(model, "encode"):
+                raise ValueError("torch-int8 不支持带任务适配器的 jina-embeddings 模型，请改用 onnx 后端")
+            model = quantize_linear(model)
+        self.model = model.to(device)
+        self.model.eval()
+
+    def encode_batch(self, sentences: list[str]) -> np.ndarray:
+        with torch.no_grad():
+            # jina-embeddings 自带 encode，可指定任务对应的 LoRA 适配器
+            if hasattr(self.model, "encode"):
+                return self.model.encode(sentences, task=TASK, batch_size=len(sentences))
+            inputs = self.tokenizer(
+                sentences, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="pt"
+            ).to(self.device)
+            outputs = self.model(**inputs)
+            return mean_pooling(outputs[0].float().cpu().numpy(), inputs["attention_mask"].cpu().numpy())
+
+
+class OnnxBackend(EmbeddingBackend):
+    def __init__(self, model_path: str, device: str):
+        import onnxruntime as ort  # type: ignore
+
+        onnx_path = os.path.join(model_path, ONNX_FILE)
+        if not os.path.exists(onnx_path):
+            from huggingface_hub import hf_hub_download
+
+            onnx_path = hf_hub_download(model_path, ONNX_FILE)
+
+        options = ort.SessionOptions()
+        if NUM_THREADS > 0:
+            options.intra_op_num_threads = NUM_THREADS
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if device == "cuda" else ["CPUExecutionProvider"]
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=providers)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+
+        # jina-embeddings-v3 的 onnx 模型需要通过 task_id 选择 LoRA 适配器
+        self.task_id = None
+        if "task_id" in self.input_names:
+            config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+            self.task_id = np.array(config.lora_adaptations.index(TASK), dtype=np.int64)
 
+    def encode_batch(self, sentences: list[str]) -> np.ndarray:
+        inputs = self.tokenizer(sentences, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="np")
+        feed = {name: value for name, value in inputs.items() if name in self.input_names}
+        if self.task_id is not None:
+            feed["task_id"] = self.task_id
+        outputs = self.session.run(None, feed)
+        return mean_pooling(outputs[0], inputs["attention_mask"])
+
+
+def weights_revision() -> str:
+    """模型权重的版本：本地目录取当前后端所用权重文件内容的哈希，HuggingFace 模型取快照对应的 commit"""
+    if not os.path.isdir(MODEL_PATH):
+        from huggingface_hub import hf_hub_download
+
+        return os.path.basename(os.path.dirname(hf_hub_download(MODEL_PATH, "config.json")))[:12]
+
+    patterns = [ONNX_FILE, f"{ONNX_FILE}_data"] if BACKEND == "onnx" else ["*.safetensors", "*.bin"]
+    digest = hashlib.sha256()
+    for path in sorted({path for pattern in patterns for path in glob(os.path.join(MODEL_PATH, pattern))}):
+        with open(path, "rb") as f:
+            while chunk := f.read(1024**2):
+                digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def get_model_id() -> str:
+    """对外报告的模型标识：模型名称@权重版本:推理后端，任一部分变化时相似度缓存都应失效"""
+    return f"{MODEL_NAME}@{weights_revision()}:{BACKEND}"
+
+
+def load_backend() -> EmbeddingBackend:
+    if BACKEND == "torch":
+        return TorchBackend(MODEL_PATH, DEVICE)
+    if BACKEND == "torch-int8":
+        return TorchBackend(MODEL_PATH, DEVICE, quantize=True)
+    if BACKEND == "onnx":
+        return OnnxBackend(MODEL_PATH, DEVICE)
+    raise ValueError(f"不支持的推理后端 {BACKEND}，支持的后端有 torch, torch-int8, onnx")
+
+
+# 模型在首次使用时加载，服务启动时会在后台线程中预先加载
+_backend: EmbeddingBackend | None = None
+_backend_error: Exception | None = None
+_model_id: str | None = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> EmbeddingBackend:
+    global _backend, _backend_error, _model_id
+    with _backend_lock:
+        if _backend is None:
+            try:
+                _model_id = get_model_id()
+                _backend = load_backend()
+                _backend_error = None
+            except Exception as e:
+                _backend_error = e
+                raise
+        return _backend
+
+
+def warm_up():
+    # 加载失败时错误已记录在 _backend_error 中，由 /ready 报告
+    with suppress(Exception):
+        get_backend()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=warm_up, daemon=True).start()
+    yield
 
-# 初始化模型
-model = AutoModel.from_pretrained("/mnt/public/model/huggingface/jina-embeddings-v3", trust_remote_code=True).cuda()
-model.eval()
 
 # 创建 FastAPI 应用
-app = FastAPI(title="Sentence Similarity API")
+app = FastAPI(title="Sentence Similarity API", lifespan=lifespan)
 
 
 # 请求体
@@ -20,19 +196,42 @@ class SimilarityRequest(BaseModel):
     sentence2: str
 
 
+class BatchSimilarityRequest(BaseModel):
+    sentence: str
+    candidates: list[str]
+
+
 # 计算相似度
 def cosine_similarity(vec1, vec2):
     return float(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
 
 
+@app.get("/ready")
+def ready():
+    info = {"model": _model_id, "backend": BACKEND, "device": DEVICE}
+    if _backend is None:
+        error = repr(_backend_error) if _backend_error else None
+        raise HTTPException(status_code=503, detail={"ready": False, "error": error, **info})
+    return {"ready": True, **info}
+
+
 @app.post("/similarity")
 def get_similarity(req: SimilarityRequest):
-    sentences = [req.sentence1, req.sentence2]
-    with torch.no_grad():
-        embeddings = model.encode(sentences, task="text-matching")
-        score = cosine_similarity(embeddings[0], embeddings[1])
+    embeddings = get_backend().encode([req.sentence1, req.sentence2])
+    score = cosine_similarity(embeddings[0], embeddings[1])
     return {"similarity": score}
 
 
+@app.post("/similarity/batch")
+def get_batch_similarity(req: BatchSimilarityRequest):
+    embeddings = get_backend().encode([req.sentence, *req.candidates])
+    scores = [cosine_similarity(embeddings[0], embedding) for embedding in embeddings[1:]]
+    return {"similarities": scores}
+
+
 # 运行命令：
-# uvicorn serve_jina_cos:app --host 0.0.0.0 --port 8000
+# JINA_MODEL_PATH=/mnt/public/model/huggingface/jina-embeddings-v3 uvicorn serve_jina_cos:app --host 0.0.0.0 --port 8000
+# CPU 节点：
+# JINA_DEVICE=cpu JINA_BACKEND=onnx JINA_NUM_THREADS=16 uvicorn serve_jina_cos:app --host 0.0.0.0 --port 8000
+# 本地验证各后端结果一致：
+# python scripts/check_serve_backends.py